@@ -1,15 +1,33 @@
 import argparse
 import sys
 import os
+import shutil
 import tempfile
+import hashlib
 import subprocess
 import shlex
 import pathlib
-import configparser
-import uuid as u
+import re
+import collections
+import functools
+import random
+import time
+
+try:
+    import fcntl
+except ImportError:  # not available on Windows
+    fcntl = None
 
 
 REPO_CONFIG_FILENAME = "slig.ini"
+INITIAL_REPO_CONFIG = {"locks": {}, "metadata": {"version": "1.0"}}
+# names allowed for new locks, locks added by older versions of slig may use other characters
+LOCK_NAME_RE = re.compile(r"\A[A-Za-z0-9_][A-Za-z0-9._-]{0,127}\Z")
+STDERR_TAIL_CHUNKS = 16  # chunks of git's stderr kept for error messages
+STDERR_ENCODING = sys.stderr.encoding or "utf-8"
+# subprocess can only use posix_spawn instead of fork + exec for executables given with a path
+GIT_EXECUTABLE = shutil.which("git") or "git"
+SH_EXECUTABLE = shutil.which("sh") or "sh"
 
 
 class GitError(RuntimeError):
@@ -18,269 +36,525 @@ class GitError(RuntimeError):
         self.stderr = stderr
 
 
+def run_forwarding_stderr(args):
+    "Run a process, forwarding its stderr to our stderr while it runs. Returns its exit code and tail of stderr (bytes)"
+
+    stderr_tail = collections.deque(maxlen=STDERR_TAIL_CHUNKS)
+    # sys.stderr may have been replaced by a text-only stream without a binary buffer
+    stderr_buffer = getattr(sys.stderr, "buffer", None)
+    # with close_fds=False subprocess uses posix_spawn, our own file descriptors are not inheritable anyway
+    with subprocess.Popen(args, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, bufsize=0,
+                          close_fds=False) as process:
+        sys.stderr.flush()
+        try:
+            for chunk in iter(lambda: process.stderr.read(4096), b""):
+                if stderr_buffer is not None:
+                    # the buffered writer retries partial writes
+                    stderr_buffer.write(chunk)
+                    stderr_buffer.flush()
+                else:
+                    sys.stderr.write(decode_stderr(chunk))
+                stderr_tail.append(chunk)
+        except BaseException:
+            # leaving the with block gives up waiting shortly after a Ctrl-C, but git may still be working
+            # in the cached clone that the next slig process can lock as soon as we exit
+            process.communicate()
+            raise
+    return (process.returncode, b"".join(stderr_tail))
+
+
+def get_cache_dir():
+    "Return the directory slig keeps its cached clones in. Raises OSError if there is none"
+
+    # relative paths in XDG_CACHE_HOME are invalid per the XDG base directory spec and are ignored
+    xdg_cache_home = os.getenv("XDG_CACHE_HOME")
+    if xdg_cache_home and os.path.isabs(xdg_cache_home):
+        return pathlib.Path(xdg_cache_home) / "slig"
+    try:
+        home = pathlib.Path.home()
+    except (RuntimeError, KeyError) as e:
+        raise OSError("Cannot determine home directory") from e
+    if not home.is_absolute():
+        raise OSError("Cannot determine home directory")
+    return home / ".cache" / "slig"
+
+
+def decode_stderr(stderr_tail):
+    # only needed for error messages; the tail may start in the middle of a character
+    return stderr_tail.decode(STDERR_ENCODING, "replace")
+
+
+def parse_repo_config(text):
+    "Parse slig.ini, made of sections of 'key = value' lines only. Raises ValueError on anything else"
+
+    # option names are case-insensitive, as with configparser which slig.ini used to be read with
+    config = {}
+    section = None
+    for line in text.splitlines():
+        stripped = line.strip()
+        if not stripped or stripped[0] in "#;":
+            continue
+        if line[0].isspace():
+            raise ValueError("Continuation line: {}".format(line))
+
+        if stripped.startswith("[") and stripped.endswith("]"):
+            section = config.setdefault(stripped[1:-1], {})
+            continue
+        (key, sep, value) = stripped.partition("=")
+        if ":" in key:
+            (key, sep, value) = stripped.partition(":")
+        if not sep or section is None:
+            raise ValueError("Unexpected line: {}".format(line))
+        section[key.strip().lower()] = value.strip()
+    return config
+
+
+def parse_legacy_repo_config(text):
+    "Parse slig.ini with configparser, for files using syntax that parse_repo_config doesn't handle"
+
+    import configparser  # rarely needed, don't pay for importing it on every call
+
+    config = configparser.ConfigParser()
+    config.read_string(text)
+    return {name: dict(config[name]) for name in config.sections()}
+
+
+def dump_repo_config(config):
+    "Format slig.ini the same way configparser does, with keys sorted so that adding or removing a lock changes one line"
+
+    return "".join("[{}]\n".format(name) +
+                   "".join("{} = {}\n".format(key, section[key]) for key in sorted(section)) +
+                   "\n"
+                   for (name, section) in config.items())
+
+
+def check_lock_name(lock_name):
+    "Exit with an error unless lock_name can be safely used as a lock file name"
+
+    # lock files are at the top level of the working tree, next to slig.ini and read-lock files
+    if (not lock_name or pathlib.PurePath(lock_name).name != lock_name or lock_name.startswith(".")
+            or ".read." in lock_name or lock_name.lower() == REPO_CONFIG_FILENAME):
+        print("Invalid lock name {}".format(lock_name), file=sys.stderr)
+        sys.exit(1)
+
+
+def check_new_lock_name(lock_name):
+    "Like check_lock_name, but also restrict the characters of a lock about to be added"
+
+    check_lock_name(lock_name)
+    if not LOCK_NAME_RE.match(lock_name):
+        print("Invalid lock name {}: use up to 128 letters, digits, '.', '_' and '-', "
+              "not starting with '.' or '-'".format(lock_name), file=sys.stderr)
+        sys.exit(1)
+
+
+def exit_on_git_error(method):
+    "Make a ClonedGitRepo method print the GitError it raises and exit with code 1"
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        try:
+            return method(self, *args, **kwargs)
+        except GitError as e:
+            print(e, file=sys.stderr)  # stderr of git is already written to stderr
+            sys.exit(1)
+
+    return wrapper
+
+
 class ClonedGitRepo:
+    @exit_on_git_error
     def __init__(self, remote, git_options):
-        "Clone remote repo into a temp directory"
+        "Update the cached clone of remote repo, or make a shallow clone of it into the cache directory"
 
         self._git_options = git_options
+        self._read_lock_counts = None
+        self._config = None
+        self._pending_config_messages = []
+        self._config_untracked = False
+        self._cache_lock = None
+        self._tmp_dir = None
 
-        parent_dir = tempfile.mkdtemp()
-        clone_result = subprocess.run(["git"] + git_options + ["clone", remote], cwd=parent_dir, capture_output=True)
-        decoded_stderr = clone_result.stderr.decode(sys.stderr.encoding)
-        print(decoded_stderr, file=sys.stderr)  # write stderr of git to stderr
-        if clone_result.returncode == 0:
-            # find cloned repository in parent_dir
-            subdirs = list(pathlib.Path(parent_dir).iterdir())
-            if len(subdirs) == 1:
-                self.name = subdirs[0].name
-                self.path = pathlib.Path(parent_dir) / self.name
-            else:
-                print("Error finding cloned repository in {}".format(parent_dir), file=sys.stderr)
-                sys.exit(1)
+        try:
+            # one cache directory per remote, holding the cloned repository
+            parent_dir = get_cache_dir() / hashlib.sha1(remote.encode()).hexdigest()
+            self._lock_cache(parent_dir.with_suffix(".lock"))
+        except OSError:
+            # no cache directory, or it is not writable (e.g. read-only filesystem) or can't be locked,
+            # clone into a temp directory instead
+            self._tmp_dir = tempfile.TemporaryDirectory()
+            parent_dir = pathlib.Path(self._tmp_dir.name)
         else:
-            print("Git process exited with code {}".format(clone_result.returncode), file=sys.stderr)
+            if parent_dir.is_dir() and self._update_cached_clone(parent_dir):
+                return
+            shutil.rmtree(parent_dir, ignore_errors=True)
+            parent_dir.mkdir(parents=True)
+
+        (returncode, stderr_tail) = run_forwarding_stderr([GIT_EXECUTABLE] + git_options +
+                                                          ["-C", str(parent_dir), "clone", "--depth=1",
+                                                           "--filter=blob:none", "--no-checkout", "--single-branch",
+                                                           "--no-tags", remote])
+        if returncode != 0:
+            raise GitError(returncode, decode_stderr(stderr_tail))
+
+        # find cloned repository in parent_dir
+        subdirs = list(pathlib.Path(parent_dir).iterdir())
+        if len(subdirs) != 1:
+            print("Error finding cloned repository in {}".format(parent_dir), file=sys.stderr)
             sys.exit(1)
+        self.name = subdirs[0].name
+        self.path = pathlib.Path(parent_dir) / self.name
+
+        self._checkout_top_level()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            if exc_type is None:
+                self.flush()
+        finally:
+            # remove the clone if it isn't cached, and let other slig processes use the cached one
+            if self._tmp_dir:
+                self._tmp_dir.cleanup()
+            if self._cache_lock:
+                self._cache_lock.close()
+
+    def _lock_cache(self, lock_path):
+        # the cached clone is shared by all slig processes using the same remote,
+        # hold an exclusive lock on it until this process exits
+        if fcntl is None:
+            # never share the clone without a lock: another process could reset away our lock files
+            raise OSError("Cannot lock {} without fcntl".format(lock_path))
+        lock_path.parent.mkdir(parents=True, exist_ok=True)
+        self._cache_lock = open(lock_path, "w")
+        fcntl.flock(self._cache_lock, fcntl.LOCK_EX)
+
+    def _update_cached_clone(self, parent_dir):
+        subdirs = list(parent_dir.iterdir())
+        if len(subdirs) != 1 or not (subdirs[0] / ".git").is_dir():
+            return False
+
+        self.name = subdirs[0].name
+        self.path = subdirs[0]
+        # a failed fetch is most likely a network problem: let it end this call, but keep the cache for the next one
+        self._call_git_command_raise(["fetch", "--prune"])
+        try:
+            # reset and clean drop whatever a previous (failed) run left behind
+            self._call_git_pipeline([["reset", "--hard", "@{upstream}"],
+                                     ["clean", "-fdx"]])
+        except GitError:
+            print("Failed to update cached clone in {}, cloning again".format(self.path), file=sys.stderr)
+            return False
+        return True
+
+    def _checkout_top_level(self):
+        # slig only uses files at the top level (slig.ini and lock files),
+        # the cone mode of sparse-checkout includes nothing else
+        (returncode, _) = self._call_git_command(["sparse-checkout", "init", "--cone"])
+        if returncode != 0:
+            # git before 2.25 has no sparse-checkout command, check out the whole repository then
+            print("Checking out all files of {}".format(self.path), file=sys.stderr)
+        (returncode, _) = self._call_git_command(["rev-parse", "--verify", "-q", "HEAD"])
+        if returncode == 0:
+            self._call_git_command_raise(["checkout"])
+        else:
+            # empty remote repository: --single-branch couldn't set up the fetch refspec
+            self._call_git_command_raise(["config", "remote.origin.fetch", "+refs/heads/*:refs/remotes/origin/*"])
+
+    def _git_args(self, commands):
+        # git -C instead of changing the working directory of the child process,
+        # self.path is absolute so it wins over any -C in the user's git options
+        return [GIT_EXECUTABLE] + self._git_options + ["-C", str(self.path)] + commands
 
     def _call_git_command(self, commands):
-        result = subprocess.run(["git"] + self._git_options + commands, cwd=self.path, capture_output=True)
-        decoded_stderr = result.stderr.decode(sys.stderr.encoding)
-        print(decoded_stderr, file=sys.stderr)  # write stderr of git to stderr
-        return (result.returncode, decoded_stderr)
+        self._read_lock_counts = None  # git may change the working tree
+        return run_forwarding_stderr(self._git_args(commands))
 
     def _call_git_command_raise(self, commands):
-        (returncode, decoded_stderr) = self._call_git_command(commands)
+        (returncode, stderr_tail) = self._call_git_command(commands)
         if returncode != 0:
-            raise GitError(returncode, decoded_stderr)
+            raise GitError(returncode, decode_stderr(stderr_tail))
+
+    def _call_git_pipeline(self, command_list):
+        "Run several git commands in a single shell, stopping at the first failing one"
+
+        if os.name != "posix":
+            for commands in command_list:
+                self._call_git_command_raise(commands)
+            return
+
+        self._read_lock_counts = None  # git may change the working tree
+        script = " && ".join(shlex.join(self._git_args(commands)) for commands in command_list)
+        (returncode, stderr_tail) = run_forwarding_stderr([SH_EXECUTABLE, "-c", script])
+        if returncode != 0:
+            raise GitError(returncode, decode_stderr(stderr_tail))
 
     def _sync_check_conflict(self):
-        # push -> pull --rebase -> push
+        # push -> pull --rebase -> push, retried while the remote keeps moving
         # the first push is for speedup
+        # --force-with-lease makes push fail if the remote branch is no longer where our
+        # remote-tracking branch says it is; as our commit is always on top of it, this is a
+        # plain fast-forward push otherwise
 
-        MAX_RETRY = 3
+        MAX_RETRY = 6
 
-        ret_code, _ = self._call_git_command(["push"])
+        ret_code, _ = self._call_git_command(["push", "--force-with-lease"])
         if ret_code == 0:
             # push successful
             return True
-        else:
-            retry_cnt = 0
-            while retry_cnt < MAX_RETRY:
-                retry_cnt += 1
-                try:
-                    self._call_git_command_raise(["pull", "--rebase"])
-                except GitError:
-                    # pull conflict: lock acquired by others
-                    return False
-
-                try:
-                    self._call_git_command_raise(["push"])
-                    return True
-                except GitError:
-                    return False
 
-            return False
+        for retry_cnt in range(MAX_RETRY):
+            if retry_cnt > 0:
+                # the remote moved again since the pull: back off exponentially, with jitter
+                # so that competing clients don't retry in lockstep
+                time.sleep(random.uniform(0.1, 0.2) * 2 ** (retry_cnt - 1))
+
+            try:
+                self._call_git_command_raise(["pull", "--rebase"])
+            except GitError:
+                # pull conflict: lock acquired by others
+                # abort the rebase so that the cached clone can be reused
+                self._call_git_command(["rebase", "--abort"])
+                return False
+
+            ret_code, _ = self._call_git_command(["push", "--force-with-lease"])
+            if ret_code == 0:
+                return True
+
+        return False
+
+    def _get_config(self):
+        "Return parsed slig.ini, which is read only once"
+
+        if self._config is None:
+            try:
+                text = (self.path / REPO_CONFIG_FILENAME).read_text()
+            except FileNotFoundError:
+                text = ""
+            try:
+                self._config = parse_repo_config(text)
+            except ValueError:
+                self._config = parse_legacy_repo_config(text)
+        return self._config
+
+    def _schedule_config_commit(self, message):
+        # changes of slig.ini are written, committed and pushed together by flush()
+        self._pending_config_messages.append(message)
+
+    @exit_on_git_error
+    def flush(self):
+        "Commit pending changes of slig.ini as one commit and push it. Called when leaving the with block"
+
+        if not self._pending_config_messages:
+            return
+
+        (self.path / REPO_CONFIG_FILENAME).write_text(dump_repo_config(self._config))
+        commands = [["commit", "-m", "\n\n".join(self._pending_config_messages), "--", REPO_CONFIG_FILENAME],
+                    ["push"]]
+        if self._config_untracked:
+            # git commit only takes files it already tracks by path
+            commands.insert(0, ["add", REPO_CONFIG_FILENAME])
+        self._call_git_pipeline(commands)
+
+        self._pending_config_messages = []
+        self._config_untracked = False
 
     def initialize(self):
-        "Create slig.in and push it into remote repository"
+        "Create slig.ini, to be pushed into remote repository by flush()"
 
-        # TODO: check if already initialized (REPO_CONFIG_FILENAME already exists)
-
-        config = configparser.ConfigParser()
-        config['locks'] = {}
-        config['metadata'] = {"version": "1.0"}
-
-        try:
-            with open(self.path / REPO_CONFIG_FILENAME, "w") as file:
-                config.write(file)
+        # the clone is up to date at this point, so the working tree tells whether slig.ini exists
+        if (self.path / REPO_CONFIG_FILENAME).exists():
+            print("Repository is already initialized", file=sys.stderr)
+            return
 
-            self._call_git_command_raise(["add", REPO_CONFIG_FILENAME])
-            self._call_git_command_raise(["commit", "-m", "initialize slig repository"])
-            self._call_git_command_raise(["push"])
-        except GitError as e:
-            print(e, file=sys.stderr)
-            sys.exit(1)
+        self._config = {name: dict(section) for (name, section) in INITIAL_REPO_CONFIG.items()}
+        self._config_untracked = True
+        self._schedule_config_commit("initialize slig repository")
 
     def add_lock(self, lock_name, lock_type):
-        config = configparser.ConfigParser()
-        try:
-            config.read(self.path / REPO_CONFIG_FILENAME)
-            if lock_name in config['locks']:
-                print("Lock {} already exists".format(lock_name), file=sys.stderr)
-                sys.exit(1)
-            else:
-                config['locks'][lock_name] = lock_type
-        except:
+        check_new_lock_name(lock_name)
+        config = self._get_config()
+        if 'locks' not in config:
             print("Cannot parse {} in target repository".format(REPO_CONFIG_FILENAME), file=sys.stderr)
+            sys.exit(1)
+        if lock_name.lower() in config['locks']:
+            print("Lock {} already exists".format(lock_name), file=sys.stderr)
+            sys.exit(1)
+        config['locks'][lock_name.lower()] = lock_type
+        self._schedule_config_commit("add {} lock: {}".format(lock_type, lock_name))
 
-        try:
-            with open(self.path / REPO_CONFIG_FILENAME, "w") as file:
-                config.write(file)
+    def remove_lock(self, lock_name):
+        check_lock_name(lock_name)
+        config = self._get_config()
+        if lock_name.lower() not in config['locks']:
+            print("Lock {} doesn't exist in repository".format(lock_name), file=sys.stderr)
+            sys.exit(1)
 
-            self._call_git_command_raise(["add", REPO_CONFIG_FILENAME])
-            self._call_git_command_raise(["commit", "-m", "add {} lock: {}".format(lock_type, lock_name)])
-            self._call_git_command_raise(["push"])
-        except GitError as e:
-            print(e, file=sys.stderr)
+        # check if lock is in use
+        if self._has_lock_file(lock_name):
+            print("Failed to remove lock {} which is currently acquired. Release it before removing."
+                    .format(lock_name), file=sys.stderr)
             sys.exit(1)
 
-    def remove_lock(self, lock_name):
-        config = configparser.ConfigParser()
-        try:
-            config.read(self.path / REPO_CONFIG_FILENAME)
-            if lock_name not in config['locks']:
-                print("Lock {} doesn't exist in repository".format(lock_name), file=sys.stderr)
-                sys.exit(1)
+        config['locks'].pop(lock_name.lower())
+        self._schedule_config_commit("remove lock: {}".format(lock_name))
 
-            # check if lock is in use
-            if lock_name in map(lambda x: x.name, pathlib.Path(self.path).iterdir()):
-                print("Failed to remove lock {} which is currently acquired. Release it before removing."
-                        .format(lock_name), file=sys.stderr)
-                sys.exit(1)
+    def _has_lock_file(self, name):
+        # a single stat() instead of listing the working tree;
+        # name may contain a user supplied uuid, so never look outside of the working tree
+        return pathlib.PurePath(name).name == name and (self.path / name).exists()
 
-            config['locks'].pop(lock_name)
-            with open(self.path / REPO_CONFIG_FILENAME, "w") as file:
-                config.write(file)
+    def _count_read_locks(self):
+        "Return number of read locks acquired for each lock, counted in one pass over the working tree"
 
-            self._call_git_command_raise(["add", REPO_CONFIG_FILENAME])
-            self._call_git_command_raise(["commit", "-m", "remove lock: {}".format(lock_name)])
-            self._call_git_command_raise(["push"])
-        except GitError as e:
-            print(e, file=sys.stderr)
-            sys.exit(1)
+        # the result is kept until the next git command
+        if self._read_lock_counts is None:
+            read_lock_counts = collections.Counter()
+            with os.scandir(self.path) as entries:
+                for entry in entries:
+                    (lock_name, read_sep, _) = entry.name.rpartition(".read.")
+                    if read_sep:
+                        read_lock_counts[lock_name] += 1
+            self._read_lock_counts = read_lock_counts
+        return self._read_lock_counts
+
+    def _read_lock_file(self, lock_name):
+        # lock files hold a uuid or READ, no need for a buffered text file to read them
+        return (self.path / lock_name).read_bytes().decode("ascii", "replace").rstrip()
 
     def _lock_acquired(self, lock_name):
-        if lock_name not in map(lambda x: x.name, pathlib.Path(self.path).iterdir()):
+        try:
+            return self._read_lock_file(lock_name) != 'READ'
+        except FileNotFoundError:
             return False
-        with open(self.path / lock_name, "r") as lock_file:
-            content = lock_file.readline()
-            return content != 'READ'
 
     def _num_read_lock_acquired(self, lock_name):
-        return len(list(filter(lambda x: x.name.startswith(lock_name + ".read."), pathlib.Path(self.path).iterdir())))
+        return self._count_read_locks()[lock_name]
 
+    @exit_on_git_error
     def acquire(self, lock_name, comment=None, rw_action=None):
-        config = configparser.ConfigParser()
-        try:
-            config.read(self.path / REPO_CONFIG_FILENAME)
-            if lock_name not in config['locks']:
-                print("Lock {} doesn't exist in repository".format(lock_name), file=sys.stderr)
-                sys.exit(1)
+        check_lock_name(lock_name)
+        config = self._get_config()
+        if lock_name.lower() not in config['locks']:
+            print("Lock {} doesn't exist in repository".format(lock_name), file=sys.stderr)
+            sys.exit(1)
 
-            lock_type = config['locks'][lock_name]
+        lock_type = config['locks'][lock_name.lower()]
 
-            # check if lock is in use
-            if lock_type == 'simple' and self._lock_acquired(lock_name):
-                print("Lock {} is currently acquired."
+        # check if lock is in use
+        if lock_type == 'simple' and self._lock_acquired(lock_name):
+            print("Lock {} is currently acquired."
+                    .format(lock_name), file=sys.stderr)
+            sys.exit(1)
+        elif lock_type == 'readwrite' and rw_action == 'read':
+            if self._lock_acquired(lock_name):
+                print("Write lock of {} is currently acquired."
+                        .format(lock_name), file=sys.stderr)
+                sys.exit(1)
+        elif lock_type == 'readwrite' and rw_action == 'write':
+            if self._lock_acquired(lock_name):
+                print("Write lock of {} is currently acquired."
+                        .format(lock_name), file=sys.stderr)
+                sys.exit(1)
+            if self._num_read_lock_acquired(lock_name) != 0:
+                print("Read locks of {} are currently acquired."
                         .format(lock_name), file=sys.stderr)
                 sys.exit(1)
-            elif lock_type == 'readwrite' and rw_action == 'read':
-                if self._lock_acquired(lock_name):
-                    print("Write lock of {} is currently acquired."
-                            .format(lock_name), file=sys.stderr)
-                    sys.exit(1)
-            elif lock_type == 'readwrite' and rw_action == 'write':
-                if self._lock_acquired(lock_name):
-                    print("Write lock of {} is currently acquired."
-                            .format(lock_name), file=sys.stderr)
-                    sys.exit(1)
-                if self._num_read_lock_acquired(lock_name) != 0:
-                    print("Read locks of {} are currently acquired."
-                            .format(lock_name), file=sys.stderr)
-                    sys.exit(1)
 
-            # try to acqurie the lock
-            # when acquiring READ lock, also write "READ" into lock1
-            # when acquiring WRITE lock, write uuid like usual
-            unique_token = str(u.uuid4())
-
-            if lock_type == 'simple' or rw_action == 'write':
-                with open(self.path / lock_name, "w") as lock_file:
-                    lock_file.write(unique_token)
-                self._call_git_command_raise(["add", lock_name])
-            elif lock_type == 'readwrite' and rw_action == 'read':
-                read_lock_name = lock_name + '.read.' + unique_token
-                with open(self.path / read_lock_name, "w") as read_lock_file:
-                    read_lock_file.write(unique_token)
-                self._call_git_command_raise(["add", read_lock_name])
-                with open(self.path / lock_name, "w") as lock_file:
-                    lock_file.write("READ")
-                self._call_git_command_raise(["add", lock_name])
-            else:
-                raise RuntimeError("Impossible branch, possibly bug in coding")
+        # try to acqurie the lock
+        # when acquiring READ lock, also write "READ" into lock1
+        # when acquiring WRITE lock, write uuid like usual
+        # formatted like a uuid, without building a uuid.UUID
+        token_hex = os.urandom(16).hex()
+        unique_token = "{}-{}-{}-{}-{}".format(token_hex[:8], token_hex[8:12], token_hex[12:16],
+                                               token_hex[16:20], token_hex[20:])
+
+        if lock_type == 'simple' or rw_action == 'write':
+            with open(self.path / lock_name, "w") as lock_file:
+                lock_file.write(unique_token)
+            added_files = [lock_name]
+        elif lock_type == 'readwrite' and rw_action == 'read':
+            read_lock_name = lock_name + '.read.' + unique_token
+            with open(self.path / read_lock_name, "w") as read_lock_file:
+                read_lock_file.write(unique_token)
+            with open(self.path / lock_name, "w") as lock_file:
+                lock_file.write("READ")
+            added_files = [read_lock_name, lock_name]
+        else:
+            raise RuntimeError("Impossible branch, possibly bug in coding")
 
-            if comment:
-                self._call_git_command_raise(["commit", "-m", "acquire lock: {}\n\n{}".format(lock_name, comment)])
-            else:
-                self._call_git_command_raise(["commit", "-m", "acquire lock: {}".format(lock_name)])
+        if comment:
+            commit_message = "acquire lock: {}\n\n{}".format(lock_name, comment)
+        else:
+            commit_message = "acquire lock: {}".format(lock_name)
+        self._call_git_pipeline([["add"] + added_files, ["commit", "-m", commit_message]])
 
-            if self._sync_check_conflict():
-                return unique_token
-            else:
-                print("Lock {} might be currently acquired."
-                        .format(lock_name), file=sys.stderr)
-                sys.exit(1)
-        except GitError as e:
-            print(e, file=sys.stderr)
+        if self._sync_check_conflict():
+            return unique_token
+        else:
+            print("Lock {} might be currently acquired."
+                    .format(lock_name), file=sys.stderr)
             sys.exit(1)
 
     # when releasing read, remove lock1.read.{uuid}, if no other read locks acquired, remove lock1 as well
     # when releasing write, remove as usual
     # force releasing a read-write lock is problematic, as we don't know exactly which lock to release
     # we simply emit an error. users should solve it manually
+    @exit_on_git_error
     def release(self, lock_name, uuid=None):
-        config = configparser.ConfigParser()
-        try:
-            config.read(self.path / REPO_CONFIG_FILENAME)
-            if lock_name not in config['locks']:
-                print("Lock {} doesn't exist in repository".format(lock_name), file=sys.stderr)
-                sys.exit(1)
+        check_lock_name(lock_name)
+        config = self._get_config()
+        if lock_name.lower() not in config['locks']:
+            print("Lock {} doesn't exist in repository".format(lock_name), file=sys.stderr)
+            sys.exit(1)
 
-            lock_type = config['locks'][lock_name]
+        lock_type = config['locks'][lock_name.lower()]
 
-            # check if lock is in use
-            if lock_name not in map(lambda x: x.name, pathlib.Path(self.path).iterdir()):
-                print("Lock {} is currently not acquired."
-                        .format(lock_name), file=sys.stderr)
-                sys.exit(1)
-            else:
-                release_read_lock = None
-                if uuid:
-                    with open(self.path / lock_name, "r") as lock_file:
-                        old_uuid = lock_file.readline()
-                        if old_uuid == 'READ':
-                            # in this case uuid should be in the reader lock
-                            # check the existence of lock_name.read.{uuid}
-                            read_lock_name = lock_name + '.read.' + uuid
-                            if read_lock_name not in map(lambda x: x.name, pathlib.Path(self.path).iterdir()):
-                                print("No reader lock in uuid: {}".format(uuid))
-                                sys.exit(1)
-                            release_read_lock = read_lock_name
-                        elif uuid != old_uuid:
-                            print("Cannot release lock {}, acquired by another uuid: {}".format(lock_name,old_uuid),
-                                  file=sys.stderr)
-                            sys.exit(1)
-                elif lock_type == 'readwrite':
-                    print("Read-write lock {} cannot be force-released, try doing it manually".format(lock_name),
-                            file=sys.stderr)
+        # check if lock is in use
+        if not self._has_lock_file(lock_name):
+            print("Lock {} is currently not acquired."
+                    .format(lock_name), file=sys.stderr)
+            sys.exit(1)
+        else:
+            release_read_lock = None
+            if uuid:
+                old_uuid = self._read_lock_file(lock_name)
+                if old_uuid == 'READ':
+                    # in this case uuid should be in the reader lock
+                    # check the existence of lock_name.read.{uuid}
+                    read_lock_name = lock_name + '.read.' + uuid
+                    if not self._has_lock_file(read_lock_name):
+                        print("No reader lock in uuid: {}".format(uuid))
+                        sys.exit(1)
+                    release_read_lock = read_lock_name
+                elif uuid != old_uuid:
+                    print("Cannot release lock {}, acquired by another uuid: {}".format(lock_name,old_uuid),
+                          file=sys.stderr)
                     sys.exit(1)
+            elif lock_type == 'readwrite':
+                print("Read-write lock {} cannot be force-released, try doing it manually".format(lock_name),
+                        file=sys.stderr)
+                sys.exit(1)
 
-                if release_read_lock:
-                    self._call_git_command_raise(["rm", release_read_lock])
-                    # if all read lock is removed
-                    if self._num_read_lock_acquired(lock_name) == 0:
-                        self._call_git_command_raise(["rm", lock_name])
-                    self._call_git_command_raise(["commit", "-m", "release read lock: {} in uuid: {}"
-                                                  .format(release_read_lock, uuid)])
-                else:
-                    self._call_git_command_raise(["rm", lock_name])
-                    self._call_git_command_raise(["commit", "-m", "release lock: {}".format(lock_name)])
-                if not self._sync_check_conflict():
-                    print("Lock {} cannot be released."
-                          .format(lock_name), file=sys.stderr)
-                    sys.exit(1)
-        except GitError as e:
-            print(e, file=sys.stderr)
-            sys.exit(1)
+            if release_read_lock:
+                removed_files = [release_read_lock]
+                # if this is the last read lock, remove lock_name as well
+                if self._num_read_lock_acquired(lock_name) == 1:
+                    removed_files.append(lock_name)
+                commit_message = "release read lock: {} in uuid: {}".format(release_read_lock, uuid)
+            else:
+                removed_files = [lock_name]
+                commit_message = "release lock: {}".format(lock_name)
+            # committing deleted files by path records their removal, no git rm needed
+            for removed_file in removed_files:
+                (self.path / removed_file).unlink()
+            self._call_git_command_raise(["commit", "-m", commit_message, "--"] + removed_files)
+            if not self._sync_check_conflict():
+                print("Lock {} cannot be released."
+                      .format(lock_name), file=sys.stderr)
+                sys.exit(1)
 
 def env_get_git_options():
     arg_str = os.getenv("SLIG_GIT_OPTIONS")
@@ -296,14 +570,23 @@ def env_get_repo():
     return repo_str
 
 
-def setup_argparse():
+def setup_argparse(action=None):
+    "Build the argument parser, with only the subparser of action if it names one"
+
     parser = argparse.ArgumentParser(description='')
     subparsers = parser.add_subparsers(title="actions")
 
-    setup_repo_subparser(subparsers)
-    setup_locks_subparser(subparsers)
-    setup_acquire_subparser(subparsers)
-    setup_release_subparser(subparsers)
+    subparser_setups = {
+        "repo": setup_repo_subparser,
+        "locks": setup_locks_subparser,
+        "acquire": setup_acquire_subparser,
+        "release": setup_release_subparser,
+    }
+    if action in subparser_setups:
+        subparser_setups[action](subparsers)
+    else:
+        for setup_subparser in subparser_setups.values():
+            setup_subparser(subparsers)
 
     return parser
 
@@ -350,44 +633,45 @@ def setup_release_subparser(subparsers):
                                 help="force releasing the lock without providing its uuid")
 
 if __name__ == "__main__":
-    parser = setup_argparse()
+    # only build the subparser of the requested action, the full parser is built for help
+    parser = setup_argparse(sys.argv[1] if len(sys.argv) > 1 else None)
     args = parser.parse_args()
     remote = env_get_repo()
     git_options = env_get_git_options()
 
     # TODO: refactor arg handling
     if args.action == "repo" and args.repo_action == 'init':
-        repo = ClonedGitRepo(remote, git_options)
-        repo.initialize()
+        with ClonedGitRepo(remote, git_options) as repo:
+            repo.initialize()
     elif args.action == "locks" and args.locks_action == 'add' and args.lock_name:
-        repo = ClonedGitRepo(remote, git_options)
-        if args.readwrite and not args.simple:
-            repo.add_lock(args.lock_name, lock_type="readwrite")
-        elif args.readwrite and args.simple:
-            parser.print_help()
-        else:
-            repo.add_lock(args.lock_name, lock_type="simple")
+        with ClonedGitRepo(remote, git_options) as repo:
+            if args.readwrite and not args.simple:
+                repo.add_lock(args.lock_name, lock_type="readwrite")
+            elif args.readwrite and args.simple:
+                setup_argparse().print_help()
+            else:
+                repo.add_lock(args.lock_name, lock_type="simple")
     elif args.action == "locks" and args.locks_action == 'delete' and args.lock_name:
-        repo = ClonedGitRepo(remote, git_options)
-        repo.remove_lock(args.lock_name)
+        with ClonedGitRepo(remote, git_options) as repo:
+            repo.remove_lock(args.lock_name)
     elif args.action == "acquire" and args.lock_name:
-        repo = ClonedGitRepo(remote, git_options)
-        if args.read and not args.write:
-            uuid = repo.acquire(args.lock_name, args.comment, rw_action="read")
-            print(uuid)  # print uuid of the lock to stdout
-        elif args.write and not args.read:
-            uuid = repo.acquire(args.lock_name, args.comment, rw_action="write")
-            print(uuid)  # print uuid of the lock to stdout
-        elif args.write and args.read:
-            parser.print_help()
-        else:
-            uuid = repo.acquire(args.lock_name, args.comment)
-            print(uuid)  # print uuid of the lock to stdout
+        with ClonedGitRepo(remote, git_options) as repo:
+            if args.read and not args.write:
+                uuid = repo.acquire(args.lock_name, args.comment, rw_action="read")
+                print(uuid)  # print uuid of the lock to stdout
+            elif args.write and not args.read:
+                uuid = repo.acquire(args.lock_name, args.comment, rw_action="write")
+                print(uuid)  # print uuid of the lock to stdout
+            elif args.write and args.read:
+                setup_argparse().print_help()
+            else:
+                uuid = repo.acquire(args.lock_name, args.comment)
+                print(uuid)  # print uuid of the lock to stdout
     elif args.action == "release" and args.lock_name and args.uuid and not args.force:
-        repo = ClonedGitRepo(remote, git_options)
-        repo.release(args.lock_name, args.uuid)
+        with ClonedGitRepo(remote, git_options) as repo:
+            repo.release(args.lock_name, args.uuid)
     elif args.action == "release" and args.lock_name and not args.uuid and args.force:
-        repo = ClonedGitRepo(remote, git_options)
-        repo.release(args.lock_name)
+        with ClonedGitRepo(remote, git_options) as repo:
+            repo.release(args.lock_name)
     else:
-        parser.print_help()
+        setup_argparse().print_help()